@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+# On-disk cache of parsed .b3d files for io_scene_b3d
+
+import os
+import json
+import mmap
+import struct
+import hashlib
+
+import numpy as np
+
+try:
+    from .B3DParser import B3DTree, dotdict
+except ImportError:
+    from B3DParser import B3DTree, dotdict
+
+# blob layout: header, json tree (arrays replaced by references), padding, array data
+MAGIC = b'B3DC'
+VERSION = 1
+HEADER = struct.Struct('<4sIQ')
+ALIGN = 64
+
+def default_cache_dir():
+    base = (os.environ.get('XDG_CACHE_HOME') or os.environ.get('LOCALAPPDATA')
+        or os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'io_scene_b3d')
+
+def file_hash(filepath):
+    h = hashlib.blake2b(digest_size=16)
+    with open(filepath, 'rb') as fp:
+        for block in iter(lambda: fp.read(1<<20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def dtype_to_json(dtype):
+    return dtype.descr if dtype.names else dtype.str
+
+def dtype_from_json(descr):
+    if isinstance(descr, str):
+        return np.dtype(descr)
+    return np.dtype([tuple(x[:2]) + tuple(tuple(s) for s in x[2:]) for x in descr])
+
+class B3DCache:
+    """Keeps array-mode B3DTree results in memory-mappable sidecar files.
+
+    Entries are keyed by absolute path, validated by size and mtime and,
+    when only the mtime changed, by a content hash after which the new
+    mtime is stored. Unreadable entries count as misses. The least
+    recently used entries are evicted once the cache exceeds max_bytes.
+    """
+
+    def __init__(self, path=None, max_bytes=2<<30):
+        self.path = path or default_cache_dir()
+        self.max_bytes = max_bytes
+
+    def entry_path(self, filepath):
+        key = hashlib.sha1(os.path.abspath(filepath).encode('utf-8', 'surrogateescape'))
+        return os.path.join(self.path, key.hexdigest() + '.b3dc')
+
+    def parse(self, filepath):
+        data = self.load(filepath)
+        if data is None:
+            data = B3DTree(use_arrays=True).parse(filepath)
+            self.store(filepath, data)
+        return data
+
+    def load(self, filepath):
+        entry = self.entry_path(filepath)
+        try:
+            fp = open(entry, 'rb')
+        except OSError:
+            return None
+        with fp:
+            try:
+                magic, version, size = HEADER.unpack(fp.read(HEADER.size))
+                if magic != MAGIC or version != VERSION:
+                    return None
+                meta = json.loads(fp.read(size))
+                st = os.stat(filepath)
+                if meta['size'] != st.st_size:
+                    return None
+                stale = meta['mtime'] != st.st_mtime_ns
+                if stale and meta['hash'] != file_hash(filepath):
+                    return None
+                buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                base = (HEADER.size + size + ALIGN-1) // ALIGN * ALIGN
+                data = self.decode(meta['data'], buf, base)
+            except (struct.error, ValueError, KeyError, TypeError):
+                # truncated or corrupt entry, parse the file again
+                return None
+        if stale:
+            # same content, store the new mtime so the next load skips the hash
+            try:
+                self.store(filepath, data, meta['hash'])
+            except OSError:
+                # still mapped by a live import on some platforms
+                pass
+        else:
+            # touch the entry, eviction drops the oldest mtimes first
+            os.utime(entry)
+        return data
+
+    def store(self, filepath, data, digest=None):
+        st = os.stat(filepath)
+        arrays = []
+        meta = {'path': os.path.abspath(filepath), 'size': st.st_size,
+            'mtime': st.st_mtime_ns, 'hash': digest or file_hash(filepath),
+            'data': self.encode(data, arrays, [0])}
+        text = json.dumps(meta, separators=(',', ':')).encode()
+        base = (HEADER.size + len(text) + ALIGN-1) // ALIGN * ALIGN
+
+        os.makedirs(self.path, exist_ok=True)
+        entry = self.entry_path(filepath)
+        tmp = '%s.%d.tmp' % (entry, os.getpid())
+        with open(tmp, 'wb') as fp:
+            fp.write(HEADER.pack(MAGIC, VERSION, len(text)))
+            fp.write(text)
+            for offset, a in arrays:
+                fp.write(b'\0' * (base + offset - fp.tell()))
+                fp.write(a.tobytes())
+        os.replace(tmp, entry)
+        self.evict()
+
+    def encode(self, obj, arrays, offset):
+        if isinstance(obj, np.ndarray):
+            a = np.ascontiguousarray(obj)
+            arrays.append((offset[0], a))
+            ref = [offset[0], dtype_to_json(a.dtype), list(a.shape)]
+            offset[0] += (a.nbytes + ALIGN-1) // ALIGN * ALIGN
+            return {'__array__': ref}
+        if isinstance(obj, dict):
+            return {k: self.encode(v, arrays, offset) for k, v in obj.items()}
+        if isinstance(obj, tuple):
+            return {'__tuple__': [self.encode(v, arrays, offset) for v in obj]}
+        if isinstance(obj, list):
+            return [self.encode(v, arrays, offset) for v in obj]
+        return obj
+
+    def decode(self, obj, buf, base):
+        if isinstance(obj, dict):
+            if '__array__' in obj:
+                offset, descr, shape = obj['__array__']
+                count = int(np.prod(shape))
+                a = np.frombuffer(buf, dtype_from_json(descr), count, base + offset)
+                return a.reshape(shape)
+            if '__tuple__' in obj:
+                return tuple(self.decode(v, buf, base) for v in obj['__tuple__'])
+            return dotdict({k: self.decode(v, buf, base) for k, v in obj.items()})
+        if isinstance(obj, list):
+            return [self.decode(v, buf, base) for v in obj]
+        return obj
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.b3dc'):
+                st = os.stat(os.path.join(self.path, name))
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+                total -= size
+            except OSError:
+                # still mapped by a live import on some platforms
+                pass
@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+# SQLite inventory of .b3d files for io_scene_b3d, runs without Blender
+
+import os
+import sys
+import time
+import sqlite3
+import argparse
+
+try:
+    from .B3DParser import B3DScanner, find_files
+except ImportError:
+    from B3DParser import B3DScanner, find_files
+
+COLUMNS = ('version', 'nodes', 'depth', 'meshes', 'vertices', 'max_vertices', 'triangles',
+    'bones', 'weights', 'keys', 'frames', 'fps')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    %s,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS textures (path TEXT NOT NULL, name TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS brushes (path TEXT NOT NULL, name TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS textures_path ON textures (path);
+CREATE INDEX IF NOT EXISTS brushes_path ON brushes (path);
+''' % ',\n    '.join('"%s" %s' % (c, 'REAL' if c=='fps' else 'INTEGER') for c in COLUMNS)
+
+def scan_worker(args):
+    path, mtime_ns, size, strict = args
+    try:
+        return path, mtime_ns, size, B3DScanner(strict=strict).scan(path), None
+    except Exception as e:
+        return path, mtime_ns, size, None, '%s: %s' % (type(e).__name__, e)
+
+class B3DCatalog:
+    """Per file counts and texture/brush names, re-scanned only when mtime or size change."""
+
+    def __init__(self, path=':memory:'):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def update(self, paths, workers=None, prune=False, strict=False):
+        from concurrent.futures import ProcessPoolExecutor
+
+        known = {path: (mtime_ns, size) for path, mtime_ns, size in
+            self.db.execute('SELECT path, mtime_ns, size FROM files')}
+        jobs = []
+        skipped = 0
+        for path in find_files(paths):
+            path = os.path.abspath(path)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if known.get(path) == (st.st_mtime_ns, st.st_size):
+                skipped += 1
+            else:
+                jobs.append((path, st.st_mtime_ns, st.st_size, strict))
+
+        errors = 0
+        pool = ProcessPoolExecutor(workers) if workers != 1 and len(jobs) > 1 else None
+        try:
+            results = pool.map(scan_worker, jobs, chunksize=16) if pool else map(scan_worker, jobs)
+            with self.db:
+                for path, mtime_ns, size, s, error in results:
+                    errors += error is not None
+                    self.store(path, mtime_ns, size, s, error)
+        finally:
+            if pool:
+                pool.shutdown()
+
+        removed = 0
+        if prune:
+            gone = [(path,) for path in known if not os.path.exists(path)]
+            with self.db:
+                for table in ['files', 'textures', 'brushes']:
+                    self.db.executemany('DELETE FROM %s WHERE path=?' % table, gone)
+            removed = len(gone)
+        return {'scanned': len(jobs), 'skipped': skipped, 'removed': removed, 'errors': errors}
+
+    def store(self, path, mtime_ns, size, s, error):
+        values = [s[c] for c in COLUMNS] if s else [None] * len(COLUMNS)
+        self.db.execute('INSERT OR REPLACE INTO files (path, mtime_ns, size, %s, error) '
+            'VALUES (%s)' % (', '.join('"%s"' % c for c in COLUMNS), ', '.join('?' * (len(COLUMNS) + 4))),
+            [path, mtime_ns, size] + values + [error])
+        for table, key in [('textures', 'textures'), ('brushes', 'materials')]:
+            self.db.execute('DELETE FROM %s WHERE path=?' % table, (path,))
+            if s:
+                self.db.executemany('INSERT INTO %s (path, name) VALUES (?, ?)' % table,
+                    [(path, name) for name in s[key]])
+
+    def query(self, where='1', params=()):
+        # where is an SQL expression over the files columns, e.g. "max_vertices > 65535"
+        cursor = self.db.execute('SELECT * FROM files WHERE %s ORDER BY path' % where, params)
+        names = [d[0] for d in cursor.description]
+        return [dict(zip(names, row)) for row in cursor]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keep an SQLite catalog of .b3d files up to date and query it.')
+    parser.add_argument('catalog', help='SQLite database file')
+    parser.add_argument('paths', nargs='*', metavar='path', help='.b3d files, directories or globs to (re)scan')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--prune', action='store_true', help='drop catalog entries for files that no longer exist')
+    parser.add_argument('--strict', action='store_true', help='validate chunk bounds and cap allocations, '
+        'malformed files are stored with an error')
+    parser.add_argument('--where', help='print files matching an SQL condition, '
+        'e.g. "max_vertices > 65535 OR bones > 64 OR frames > 1000"')
+    args = parser.parse_args()
+
+    with B3DCatalog(args.catalog) as catalog:
+        if args.paths or args.prune:
+            start = time.perf_counter()
+            summary = catalog.update(args.paths, args.workers, args.prune, args.strict)
+            summary['time'] = time.perf_counter() - start
+            print('%(scanned)d scanned, %(skipped)d unchanged, %(removed)d removed, '
+                '%(errors)d errors, %(time).2fs' % summary, file=sys.stderr)
+        if args.where:
+            columns = ('path',) + COLUMNS + ('error',)
+            print('\t'.join(columns))
+            for row in catalog.query(args.where):
+                print('\t'.join('' if row[c] is None else str(row[c]) for c in columns))
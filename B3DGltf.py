@@ -0,0 +1,316 @@
+#!/usr/bin/python3
+# Blender-free .b3d to binary glTF (.glb) converter for io_scene_b3d
+
+import os
+import sys
+import json
+import time
+import struct
+import argparse
+
+import numpy as np
+
+try:
+    from .B3DParser import B3DTree, find_files
+except ImportError:
+    from B3DParser import B3DTree, find_files
+
+# glTF is right handed, B3D left handed with the same Y up: mirror Z.
+# Quaternions follow the importer convention, (w,x,y,z) -> (x,y,-z,w).
+MIRROR = np.array([1, 1, -1], np.float32)
+
+COMPONENT_TYPES = {
+    np.dtype(np.int8): 5120, np.dtype(np.uint8): 5121,
+    np.dtype(np.int16): 5122, np.dtype(np.uint16): 5123,
+    np.dtype(np.uint32): 5125, np.dtype(np.float32): 5126,
+}
+ACCESSOR_TYPES = {1: 'SCALAR', 2: 'VEC2', 3: 'VEC3', 4: 'VEC4', 16: 'MAT4'}
+ARRAY_BUFFER = 34962
+ELEMENT_ARRAY_BUFFER = 34963
+
+def trs_matrix(t, r, s):
+    x, y, z, w = r
+    m = np.array([
+        [1-2*(y*y+z*z), 2*(x*y-z*w), 2*(x*z+y*w), t[0]],
+        [2*(x*y+z*w), 1-2*(x*x+z*z), 2*(y*z-x*w), t[1]],
+        [2*(x*z-y*w), 2*(y*z+x*w), 1-2*(x*x+y*y), t[2]],
+        [0, 0, 0, 1]], np.float64)
+    m[:3, :3] *= s
+    return m
+
+def convert_position(p):
+    return (np.asarray(p, np.float32) * MIRROR).tolist()
+
+def convert_rotation(r):
+    w, x, y, z = r
+    return [x, y, -z, w]
+
+class GLBWriter:
+    def __init__(self):
+        self.gltf = {'asset': {'version': '2.0', 'generator': 'io_scene_b3d'},
+            'scene': 0, 'scenes': [{'nodes': []}], 'nodes': [],
+            'buffers': [], 'bufferViews': [], 'accessors': []}
+        self.blobs = []
+        self.size = 0
+
+    def add(self, name, item):
+        self.gltf.setdefault(name, []).append(item)
+        return len(self.gltf[name]) - 1
+
+    def accessor(self, a, target=None, minmax=False):
+        a = np.ascontiguousarray(a)
+        count = len(a)
+        width = int(np.prod(a.shape[1:]))
+        view = {'buffer': 0, 'byteOffset': self.size, 'byteLength': a.nbytes}
+        if target:
+            view['target'] = target
+        self.blobs.append(a.tobytes())
+        # every view starts 4-byte aligned
+        pad = -a.nbytes % 4
+        if pad:
+            self.blobs.append(b'\0' * pad)
+        self.size += a.nbytes + pad
+        accessor = {'bufferView': self.add('bufferViews', view),
+            'componentType': COMPONENT_TYPES[a.dtype], 'count': count,
+            'type': ACCESSOR_TYPES[width]}
+        if minmax and count:
+            flat = a.reshape(count, width)
+            accessor['min'] = flat.min(axis=0).tolist()
+            accessor['max'] = flat.max(axis=0).tolist()
+        return self.add('accessors', accessor)
+
+    def write(self, fp):
+        self.gltf['buffers'] = [{'byteLength': self.size}]
+        text = json.dumps(self.gltf, separators=(',', ':')).encode()
+        text += b' ' * (-len(text) % 4)
+        fp.write(struct.pack('<4sII', b'glTF', 2, 12 + 8 + len(text) + 8 + self.size))
+        fp.write(struct.pack('<I4s', len(text), b'JSON'))
+        fp.write(text)
+        fp.write(struct.pack('<I4s', self.size, b'BIN\0'))
+        for blob in self.blobs:
+            fp.write(blob)
+
+class B3DGltf:
+    """Converts an array-mode B3DTree result into a GLBWriter."""
+
+    def __init__(self, data):
+        self.data = data
+        self.out = GLBWriter()
+        self.world = {}
+        self.skins = []
+        self.fps = data.get('fps') or 60.0
+        self.channels = []
+        self.samplers = []
+
+    def convert(self):
+        self.convert_materials()
+        for node in self.data.nodes:
+            self.out.gltf['scenes'][0]['nodes'].append(self.convert_node(node, np.identity(4), None))
+        for mesh_node, index, joints in self.skins:
+            self.convert_skin(mesh_node, index, joints)
+        if self.channels:
+            self.out.add('animations', {'name': 'default',
+                'channels': self.channels, 'samplers': self.samplers})
+        return self.out
+
+    def convert_materials(self):
+        textures = self.data.get('textures') or []
+        for texture in textures:
+            image = self.out.add('images', {'uri': texture['name'].replace('\\', '/')})
+            self.out.add('textures', {'source': image})
+        for mat in self.data.get('materials') or []:
+            pbr = {'baseColorFactor': list(mat.rgba), 'metallicFactor': 0.0, 'roughnessFactor': 1.0}
+            if len(mat.tids) and 0 <= mat.tids[0] < len(textures):
+                pbr['baseColorTexture'] = {'index': mat.tids[0]}
+            material = {'name': mat.name, 'pbrMetallicRoughness': pbr}
+            if mat.rgba[3] < 1.0:
+                material['alphaMode'] = 'BLEND'
+            self.out.add('materials', material)
+
+    def convert_node(self, node, parent_world, mesh_node):
+        t = convert_position(node.position)
+        r = convert_rotation(node.rotation)
+        s = list(node.scale)
+        gnode = {'name': node.name, 'translation': t, 'rotation': r, 'scale': s}
+        index = self.out.add('nodes', gnode)
+        self.world[index] = parent_world @ trs_matrix(t, r, s)
+
+        if node.get('vertices') is not None and len(node.get('faces') or []):
+            gnode['mesh'] = self.convert_mesh(node)
+            mesh_node = (node, index, [])
+            self.skins.append(mesh_node)
+        elif node.get('bones') is not None and mesh_node:
+            mesh_node[2].append((index, node.bones))
+
+        if node.get('keys') is not None:
+            self.convert_keys(index, node['keys'])
+
+        children = [self.convert_node(c, self.world[index], mesh_node) for c in node.nodes]
+        if children:
+            gnode['children'] = children
+        return index
+
+    def convert_mesh(self, node):
+        out = self.out
+        attributes = {'POSITION': out.accessor(node.vertices * MIRROR, ARRAY_BUFFER, minmax=True)}
+        if len(node.normals):
+            attributes['NORMAL'] = out.accessor(node.normals * MIRROR, ARRAY_BUFFER)
+        if len(node.rgba):
+            attributes['COLOR_0'] = out.accessor(np.clip(node.rgba, 0, 1), ARRAY_BUFFER)
+        # glTF texture coordinates are U/V pairs, extra components are dropped
+        tcs, tcss = node.tex_coord_sets, node.tex_coord_set_size
+        if len(node.uvs) and tcss >= 2:
+            for i in range(tcs):
+                attributes['TEXCOORD_%d' % i] = out.accessor(node.uvs[:, i*tcss:i*tcss+2], ARRAY_BUFFER)
+
+        primitives = []
+        count = len(node.vertices)
+        index_type = np.uint16 if count < 65536 else np.uint32
+        for face in node.faces:
+            if not len(face.indices):
+                continue
+            # mirroring flips the winding as well
+            indices = face.indices[:, [0, 2, 1]].astype(index_type)
+            primitive = {'attributes': dict(attributes),
+                'indices': out.accessor(indices.reshape(-1), ELEMENT_ARRAY_BUFFER)}
+            brush_id = face.brush_id if face.brush_id != -1 else node.get('brush_id', -1)
+            if 0 <= brush_id < len(out.gltf.get('materials', [])):
+                primitive['material'] = brush_id
+            primitives.append(primitive)
+        return out.add('meshes', {'name': node.name, 'primitives': primitives})
+
+    def convert_skin(self, mesh_node, index, joints):
+        if not joints:
+            return
+        node = mesh_node
+        count = len(node.vertices)
+        # joint 0 is the mesh node itself and holds vertices without weights
+        joint_ids = np.concatenate([np.full(len(bones), j+1, np.int64)
+            for j, (_, bones) in enumerate(joints)])
+        vertex_ids = np.concatenate([bones['vertex_id'] for _, bones in joints]).astype(np.int64)
+        weights = np.concatenate([bones['weight'] for _, bones in joints]).astype(np.float32)
+        valid = (vertex_ids >= 0) & (vertex_ids < count) & (weights > 0)
+        joint_ids, vertex_ids, weights = joint_ids[valid], vertex_ids[valid], weights[valid]
+
+        # keep the 4 strongest influences per vertex
+        order = np.lexsort((-weights, vertex_ids))
+        joint_ids, vertex_ids, weights = joint_ids[order], vertex_ids[order], weights[order]
+        first = np.searchsorted(vertex_ids, vertex_ids)
+        rank = np.arange(len(vertex_ids)) - first
+        keep = rank < 4
+        J = np.zeros((count, 4), np.uint16)
+        W = np.zeros((count, 4), np.float32)
+        J[vertex_ids[keep], rank[keep]] = joint_ids[keep]
+        W[vertex_ids[keep], rank[keep]] = weights[keep]
+        total = W.sum(axis=1, keepdims=True)
+        W[total[:, 0] == 0, 0] = 1.0
+        W /= np.where(total == 0, 1.0, total)
+
+        out = self.out
+        joints_accessor = out.accessor(J, ARRAY_BUFFER)
+        weights_accessor = out.accessor(W, ARRAY_BUFFER)
+        for primitive in out.gltf['meshes'][out.gltf['nodes'][index]['mesh']]['primitives']:
+            primitive['attributes']['JOINTS_0'] = joints_accessor
+            primitive['attributes']['WEIGHTS_0'] = weights_accessor
+
+        nodes = [index] + [j for j, _ in joints]
+        mesh_world = self.world[index]
+        ibms = np.array([(np.linalg.inv(self.world[j]) @ mesh_world).T for j in nodes], np.float32)
+        skin = {'joints': nodes, 'inverseBindMatrices': out.accessor(ibms.reshape(len(nodes), 16))}
+        out.gltf['nodes'][index]['skin'] = out.add('skins', skin)
+
+    def convert_keys(self, index, keys):
+        if not isinstance(keys, dict):
+            return
+        for bit, path, name in [(1, 'translation', 'position'), (4, 'rotation', 'rotation'),
+                (2, 'scale', 'scale')]:
+            if name not in keys:
+                continue
+            mask = (keys.flags & bit) != 0
+            if not mask.any():
+                continue
+            frames = keys.frames[mask]
+            order = np.argsort(frames, kind='stable')
+            frames, values = frames[order], keys[name][mask][order]
+            unique = np.concatenate(([True], frames[1:] != frames[:-1]))
+            frames, values = frames[unique], values[unique]
+            if path == 'translation':
+                values = values * MIRROR
+            elif path == 'rotation':
+                values = values[:, [1, 2, 3, 0]] * np.array([1, 1, -1, 1], np.float32)
+            times = (frames / self.fps).astype(np.float32)
+            sampler = {'input': self.out.accessor(times, minmax=True),
+                'output': self.out.accessor(values.astype(np.float32)), 'interpolation': 'LINEAR'}
+            self.samplers.append(sampler)
+            self.channels.append({'sampler': len(self.samplers)-1,
+                'target': {'node': index, 'path': path}})
+
+def convert(source, dest, strict=False):
+    data = B3DTree(use_arrays=True, strict=strict).parse(source)
+    out = B3DGltf(data).convert()
+    with open(dest, 'wb') as fp:
+        out.write(fp)
+
+def convert_worker(args):
+    source, dest, strict = args
+    start = time.perf_counter()
+    try:
+        convert(source, dest, strict)
+        return source, dest, None, time.perf_counter() - start
+    except Exception as e:
+        return source, dest, '%s: %s' % (type(e).__name__, e), time.perf_counter() - start
+
+def convert_all(paths, outdir=None, workers=None, strict=False):
+    from concurrent.futures import ProcessPoolExecutor
+    sources = {}
+    for source in find_files(paths):
+        sources.setdefault(os.path.abspath(source), source)
+    if outdir and sources:
+        # keep the layout below the common parent, so equal basenames do not collide
+        base = os.path.commonpath([os.path.dirname(source) for source in sources])
+    jobs = []
+    dests = {}
+    for path, source in sources.items():
+        dest = os.path.splitext(source)[0] + '.glb'
+        if outdir:
+            dest = os.path.join(outdir, os.path.relpath(os.path.splitext(path)[0] + '.glb', base))
+        key = os.path.normcase(os.path.abspath(dest))
+        if key in dests:
+            raise ValueError('%s and %s both convert to %s' % (dests[key], source, dest))
+        dests[key] = source
+        jobs.append((source, dest, strict))
+    if outdir:
+        for job in jobs:
+            os.makedirs(os.path.dirname(job[1]), exist_ok=True)
+    errors = 0
+    pool = ProcessPoolExecutor(workers) if workers != 1 else None
+    try:
+        results = pool.map(convert_worker, jobs, chunksize=4) if pool else map(convert_worker, jobs)
+        for source, dest, error, seconds in results:
+            if error:
+                errors += 1
+                print('%s: %s' % (source, error), file=sys.stderr)
+            else:
+                print('%s -> %s (%.2fs)' % (source, dest, seconds))
+    finally:
+        if pool:
+            pool.shutdown()
+    return errors
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert .b3d files to binary glTF (.glb).')
+    parser.add_argument('paths', nargs='+', metavar='path', help='.b3d files, directories or globs')
+    parser.add_argument('-o', '--output', help='output .glb file (single input) or directory')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--strict', action='store_true', help='reject malformed files and cap allocations')
+    args = parser.parse_args()
+
+    if len(args.paths) == 1 and os.path.isfile(args.paths[0]) and args.output \
+            and args.output.lower().endswith('.glb'):
+        convert(args.paths[0], args.output, args.strict)
+        sys.exit(0)
+    try:
+        errors = convert_all(args.paths, args.output, args.workers, args.strict)
+    except ValueError as e:
+        parser.error(str(e))
+    sys.exit(1 if errors else 0)
@@ -1,142 +1,549 @@
 #!/usr/bin/python3
 # by Joric, https://github.com/joric/io_scene_b3d
 
+import io
 import os
+import sys
+import glob
+import mmap
+import time
 import struct
+import zipfile
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import Future, ThreadPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+if np is not None:
+    TRIS_DTYPE = np.dtype(('<i4', 3))
+    BONE_DTYPE = np.dtype([('vertex_id', '<i4'), ('weight', '<f4')])
+
+CONTAINERS = ('BB3D', 'NODE', 'MESH')
+LAZY_FIELDS = {
+    'VRTS': ('vertices', 'normals', 'rgba', 'uvs', 'tex_coord_sets', 'tex_coord_set_size'),
+    'TRIS': ('faces',),
+    'BONE': ('bones',),
+    'KEYS': ('keys',),
+}
+THREADED_CHUNK_SIZE = 1<<16
+# compiled formats for i(n) and f(n), larger counts are compiled per call
+INTS = {n: struct.Struct('<%di' % n) for n in range(33)}
+FLOATS = {n: struct.Struct('<%df' % n) for n in range(33)}
+KEYS_FIELDS = ((1, 'position', 3), (2, 'scale', 3), (4, 'rotation', 4))
+
+# strict mode, smallest valid size per chunk tag (headers included) and default caps
+MIN_SIZES = {'BB3D':4, 'TEXS':0, 'BRUS':4, 'NODE':41, 'MESH':4, 'VRTS':12,
+    'TRIS':4, 'BONE':0, 'KEYS':4, 'ANIM':12}
+# strict mode, the only container each of these chunks may sit in
+PARENT_TAGS = {'MESH':'NODE', 'VRTS':'MESH', 'TRIS':'MESH', 'BONE':'NODE', 'KEYS':'NODE'}
+STRICT_LIMITS = {
+    'depth': 256,           # nested BB3D/NODE/MESH chunks
+    'elements': 1<<24,      # vertices, triangles, weights, keys... in one chunk
+    'total': 1<<26,         # elements in the whole file
+    'textures': 8,          # BRUS n_texs and VRTS texture coordinate sets
+    'string': 4096,         # bytes in a name
+    'seconds': None,        # wall clock budget for one parse
+}
+
+class B3DError(ValueError):
+    """Raised on negative chunk sizes, and by strict mode when a file breaks the format or a limit."""
+
+    def __init__(self, reason, chunk=None, offset=None, **details):
+        self.reason = reason
+        self.chunk = chunk
+        self.offset = offset
+        self.details = details
+        where = ' in %s' % chunk if chunk else ''
+        where += ' at offset %d' % offset if offset is not None else ''
+        extra = ', '.join('%s=%s' % item for item in sorted(details.items()))
+        ValueError.__init__(self, reason + where + (' (%s)' % extra if extra else ''))
+
+    def as_dict(self):
+        return dict(self.details, reason=self.reason, chunk=self.chunk, offset=self.offset)
+
+class ParseStats:
+    """Per chunk tag counters filled in by B3DParser(profile=True).
+
+    Rows map a chunk tag, or '(strings)', '(callbacks)' and '(result)',
+    to count, bytes, seconds and net allocated memory blocks. Chunk rows
+    exclude the time spent in strings and callbacks.
+    """
 
-class B3DParser:
     def __init__(self):
+        self.rows = {}
+        self.inner = (0.0, 0)
+
+    def add(self, tag, size, seconds, allocated):
+        row = self.rows.get(tag)
+        if row is None:
+            row = self.rows[tag] = dotdict({'count':0, 'bytes':0, 'time':0.0, 'blocks':0})
+        row.count += 1
+        row.bytes += size
+        row.time += seconds
+        row.blocks += allocated
+
+    def table(self):
+        total = sum(row.time for row in self.rows.values()) or 1.0
+        lines = ['%-12s %10s %12s %10s %6s %12s' % ('chunk', 'count', 'bytes', 'ms', '%', 'blocks')]
+        for tag, row in sorted(self.rows.items(), key=lambda x: -x[1].time):
+            lines.append('%-12s %10d %12d %10.2f %6.1f %12d' % (tag, row.count, row.bytes,
+                row.time*1000, row.time*100/total, row.blocks))
+        return '\n'.join(lines)
+
+
+class B3DParser:
+    def __init__(self, use_mmap=True, use_arrays=False, include=None, exclude=None, profile=False,
+            strict=False, limits=None):
+        if use_arrays and np is None:
+            raise ImportError('use_arrays requires numpy')
+        self.stats = None
+        if profile:
+            self.enable_profile()
+        if strict:
+            self.enable_strict(limits)
+        # chunk tag filters, BB3D and NODE are always read to keep the structure
+        self.include = set(include) | {'BB3D', 'NODE', 'MESH'} if include is not None else None
+        self.exclude = set(exclude or ()) - {'BB3D', 'NODE'}
+        self.filtered = self.include is not None or bool(self.exclude)
         self.fp = None
+        self.buf = None
+        self.view = None
+        self.pos = 0
+        self.strings = {}
+        self.cleanup = []
+        self.use_mmap = use_mmap
+        self.use_arrays = use_arrays
+
+    def open(self, source):
+        # source is a path, a bytes-like object, a binary file or a zipfile.Path,
+        # files are read from their current position like fp.read() would
+        self.cleanup = []
+        if isinstance(source, (str, os.PathLike)):
+            self.fp = open(source,'rb')
+            self.cleanup.append(self.fp.close)
+            self.buf = self.map_file(self.fp)
+        elif isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+            self.buf = source
+        elif hasattr(zipfile, 'Path') and isinstance(source, zipfile.Path):
+            self.buf = self.map_zip_member(source.root, source.at)
+        elif hasattr(source, 'getbuffer'):
+            self.buf = self.from_position(source.getbuffer(), source.tell())
+        else:
+            self.buf = self.map_file(source)
+        self.view = memoryview(self.buf).cast('B')
+        self._find_nul = getattr(self.buf, 'find', self.find_view)
+        self.pos = 0
+        self.strings = {}
+        return len(self.view)
+
+    def map_file(self, fp):
+        try:
+            fileno = fp.fileno()
+            filesize = os.fstat(fileno).st_size
+            offset = fp.tell()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return fp.read()
+        if not (self.use_mmap and filesize > offset):
+            return fp.read()
+        return self.from_position(mmap.mmap(fileno, 0, access=mmap.ACCESS_READ), offset)
+
+    def from_position(self, buf, offset):
+        # buf starts at byte 0 of the stream, keep the part from offset on
+        self.cleanup.append(getattr(buf, 'close', None) or buf.release)
+        if not offset:
+            return buf
+        view = memoryview(buf)[offset:]
+        self.cleanup.insert(0, view.release)
+        return view
+
+    def map_zip_member(self, archive, name):
+        # stored members are mapped straight out of the archive, others are inflated
+        info = archive.getinfo(name)
+        stored = info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 1
+        if stored and self.use_mmap and info.file_size:
+            try:
+                buf = mmap.mmap(archive.fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+                return archive.read(name)
+            self.cleanup.append(buf.close)
+            offset = info.header_offset
+            if buf[offset:offset+4] == b'PK\x03\x04':
+                n, extra = struct.unpack_from('<HH', buf, offset + 26)
+                start = offset + 30 + n + extra
+                view = memoryview(buf)[start:start+info.file_size]
+                self.cleanup.insert(0, view.release)
+                return view
+        return archive.read(name)
+
+    def find_view(self, sub, pos):
+        # memoryview has no find(), search it block by block
+        while pos < len(self.view):
+            end = bytes(self.view[pos:pos+256]).find(sub)
+            if end >= 0:
+                return pos + end
+            pos += 256
+        return -1
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+        for cleanup in self.cleanup:
+            cleanup()
+        self.cleanup = []
+        self.fp = self.buf = self.view = None
 
     def gets(self):
-        s = b''
-        while True:
-            c = self.fp.read(1)
-            if c == b'\x00':
-                return s.decode(errors='ignore')
-            s += c
+        end = self._find_nul(b'\0', self.pos)
+        if end < 0:
+            end = len(self.view)
+        raw = bytes(self.view[self.pos:end])
+        self.pos = end + 1
+        # names repeat a lot (bones in every rig), decode each one once
+        s = self.strings.get(raw)
+        if s is None:
+            s = self.strings[raw] = raw.decode(errors='ignore')
+        return s
 
     def i(self,n):
-        return struct.unpack(n*'i', self.fp.read(n*4))
+        v = (INTS.get(n) or struct.Struct('<%di' % n)).unpack_from(self.view, self.pos)
+        self.pos += n*4
+        return v
 
     def f(self,n):
-        return struct.unpack(n*'f', self.fp.read(n*4))
+        v = (FLOATS.get(n) or struct.Struct('<%df' % n)).unpack_from(self.view, self.pos)
+        self.pos += n*4
+        return v
 
     def next_chunk(self):
-        pos = self.fp.tell()
-        s1,s2,s3,s4, size = struct.unpack('4ci', self.fp.read(8))
-        chunk = ''.join([chr(ord(x)) for x in (s1,s2,s3,s4)])
+        pos = self.pos
+        tag, size = struct.unpack_from('<4si', self.view, pos)
+        chunk = tag.decode('latin-1')
+        if size < 0:
+            # the walk would stall or step back, strict mode or not
+            raise B3DError('bad chunk size', chunk, pos, size=size)
         next = pos + size + 8
+        self.pos = pos + 8
         return chunk, pos, size, next
 
+    def records(self, dtype, next):
+        count = (next - self.pos) // dtype.itemsize
+        a = np.frombuffer(self.view, dtype, count, self.pos)
+        self.pos += count * dtype.itemsize
+        return a
+
+    def array(self, dtype, next):
+        # copy out of the mapping so the result outlives close()
+        return self.records(dtype, next).copy()
+
+    def vrts_arrays(self, flags, tcs, tcss, next):
+        fields = [('vertices', '<f4', 3)]
+        if flags & 1: fields.append(('normals', '<f4', 3))
+        if flags & 2: fields.append(('rgba', '<f4', 4))
+        if tcs*tcss: fields.append(('uvs', '<f4', tcs*tcss))
+        a = self.array(np.dtype(fields), next)
+        empty = {'normals':3, 'rgba':4, 'uvs':tcs*tcss}
+        data = {k: np.empty((0, n), np.float32) for k, n in empty.items()}
+        data.update({k: a[k] for k in a.dtype.names})
+        data.update({'tex_coord_sets': tcs, 'tex_coord_set_size': tcss})
+        return data
+
+    def keys_arrays(self, flags, next):
+        fields = [('frames', '<i4')]
+        fields += [(name, '<f4', n) for bit, name, n in KEYS_FIELDS if flags & bit]
+        a = self.records(np.dtype(fields), next)
+        # copy every column, with flags 0 a lone frames column would stay a view of the mapping
+        keys = dotdict({name: np.array(a[name]) for name in a.dtype.names})
+        keys.flags = np.full(len(a), flags, np.int32)
+        return keys
+
     def cb_result(self):
         return True
 
-    def parse(self, filepath):
-        filesize = os.stat(filepath).st_size
-        self.fp = open(filepath,'rb')
+    def parse(self, source):
+        filesize = self.open(source)
+        try:
+            self.parse_chunks(filesize)
+        finally:
+            self.close()
+        return self.cb_result()
+
+    def parse_chunks(self, filesize):
+        for chunk in self.iter_chunks(filesize):
+            pass
+
+    def iter_chunks(self, filesize):
         stack = []
-        while self.fp.tell() <= filesize-8:
+        while self.pos <= filesize-8:
 
-            while stack and stack[-1]==self.fp.tell():
+            while stack and stack[-1]==self.pos:
                 del stack[-1]
                 self.cb_prev()
 
             chunk, pos, size, next = self.next_chunk()
 
-            if chunk=='BB3D':
-                self.cb_data(chunk, {'version': self.i(1)[0]})
-                continue
+            if chunk=='NODE':
+                self.cb_next()
+                stack.append(next)
 
-            if chunk=='ANIM':
-                flags, frames = self.i(2)
-                fps = self.f(1)[0]
-                self.cb_data(chunk, {'flags':flags, 'frames':frames, 'fps':fps})
+            if self.filtered and not self.wanted(chunk):
+                self.pos = next
+            else:
+                self.parse_chunk(chunk, next)
+                if chunk not in CONTAINERS:
+                    self.pos = next
 
-            elif chunk=='TEXS':
-                data = []
-                while self.fp.tell()<next:
-                    name = self.gets()
-                    flags, blend = self.i(2)
-                    pos = self.f(2)
-                    scale = self.f(2)
-                    rot = self.f(1)[0]
-                    data.append(dotdict({'name':name,'position':pos,'scale':scale,'rotation':rot}))
-                self.cb_data(chunk,{'textures':data})
+            yield chunk
 
-            elif chunk=='BRUS':
-                n_texs = self.i(1)[0]
-                data = []
-                while self.fp.tell()<next:
-                    name = self.gets()
-                    rgba = self.f(4)
-                    shine = self.f(1)[0]
-                    blend, fx = self.i(2)
-                    tids = self.i(n_texs)
-                    data.append(dotdict({'name':name, 'rgba':rgba,'shine':shine, 'blend':blend,'fx':fx,'tids':tids}))
-                self.cb_data(chunk, {'materials':data})
+        while stack:
+            del stack[-1]
+            self.cb_prev()
 
-            elif chunk=='NODE':
-                self.cb_next()
-                stack.append(next)
+    def enable_profile(self):
+        # wrap the hot methods on the instance only, so the default path is untouched
+        self.stats = stats = ParseStats()
+        parse_chunk, gets, cb_data, cb_result = self.parse_chunk, self.gets, self.cb_data, self.cb_result
+        clock, blocks = time.perf_counter, sys.getallocatedblocks
+
+        def timed(tag, func):
+            def wrapper(*args):
+                start = self.pos
+                b, t = blocks(), clock()
+                result = func(*args)
+                seconds, allocated = clock()-t, blocks()-b
+                stats.add(tag, self.pos-start, seconds, allocated)
+                stats.inner = (stats.inner[0] + seconds, stats.inner[1] + allocated)
+                return result
+            return wrapper
+
+        def profiled_parse_chunk(chunk, next):
+            start = self.pos
+            inner = stats.inner
+            b, t = blocks(), clock()
+            parse_chunk(chunk, next)
+            seconds, allocated = clock()-t, blocks()-b
+            size = (self.pos if chunk in CONTAINERS else next) - start
+            # strings and callbacks are reported in their own rows
+            stats.add(chunk, size, seconds - (stats.inner[0]-inner[0]),
+                allocated - (stats.inner[1]-inner[1]))
+
+        self.parse_chunk = profiled_parse_chunk
+        self.gets = timed('(strings)', gets)
+        self.cb_data = timed('(callbacks)', cb_data)
+        self.cb_result = timed('(result)', cb_result)
+
+    def enable_strict(self, limits=None):
+        # like profiling, checks are wrapped around the instance methods only
+        limits = dict(STRICT_LIMITS, **(limits or {}))
+        open_, next_chunk, parse_chunk, gets = self.open, self.next_chunk, self.parse_chunk, self.gets
+        max_depth, max_elements, max_total, max_string = (limits[k] for k in
+            ['depth', 'elements', 'total', 'string'])
+        stack = []
+        chunk_end = total = 0
+        deadline = None
+        clock = time.perf_counter
+
+        def strict_open(source):
+            nonlocal chunk_end, total, deadline
+            filesize = open_(source)
+            del stack[:]
+            chunk_end, total = filesize, 0
+            deadline = clock() + limits['seconds'] if limits['seconds'] is not None else None
+            if filesize < 12 or bytes(self.view[:4]) != b'BB3D':
+                raise B3DError('not a B3D file', offset=0, size=filesize)
+            return filesize
+
+        def strict_next_chunk():
+            nonlocal chunk_end
+            pos = self.pos
+            while stack and stack[-1][0] <= pos:
+                del stack[-1]
+            end, parent = stack[-1] if stack else (len(self.view), None)
+            if deadline is not None and clock() > deadline:
+                raise B3DError('time limit exceeded', offset=pos, seconds=limits['seconds'])
+            if pos + 8 > end:
+                raise B3DError('truncated chunk header', offset=pos, end=end)
+            chunk, pos, size, next = next_chunk()
+            if size < MIN_SIZES.get(chunk, 0):
+                raise B3DError('bad chunk size', chunk, pos, size=size)
+            if next > end:
+                raise B3DError('chunk overruns its parent' if stack else 'chunk overruns the file',
+                    chunk, pos, size=size, end=end)
+            if chunk in PARENT_TAGS and parent != PARENT_TAGS[chunk]:
+                raise B3DError('misplaced chunk', chunk, pos, parent=parent, expected=PARENT_TAGS[chunk])
+            if chunk in CONTAINERS:
+                if len(stack) >= max_depth:
+                    raise B3DError('nesting too deep', chunk, pos, depth=len(stack)+1)
+                stack.append((next, chunk))
+            chunk_end = next
+            return chunk, pos, size, next
+
+        def strict_parse_chunk(chunk, next):
+            nonlocal total
+            pos = self.pos
+            if chunk not in CONTAINERS and chunk != 'ANIM':
+                count = self.count_elements(chunk, next, limits)
+                if count > max_elements:
+                    raise B3DError('too many elements', chunk, pos-8, count=count)
+                total += count
+                if total > max_total:
+                    raise B3DError('too many elements in file', chunk, pos-8, total=total)
+            try:
+                parse_chunk(chunk, next)
+            except struct.error as e:
+                raise B3DError('truncated chunk', chunk, pos-8, error=str(e))
+            if self.pos > next:
+                raise B3DError('payload overruns chunk', chunk, pos-8, read=self.pos-pos, size=next-pos)
+
+        def strict_gets():
+            start = self.pos
+            s = gets()
+            if self.pos > chunk_end:
+                raise B3DError('unterminated string', offset=start)
+            if self.pos - start - 1 > max_string:
+                raise B3DError('string too long', offset=start, length=self.pos-start-1)
+            return s
+
+        self.open = strict_open
+        self.next_chunk = strict_next_chunk
+        self.parse_chunk = strict_parse_chunk
+        self.gets = strict_gets
+
+    def count_elements(self, chunk, next, limits):
+        # element count from the chunk header alone, the payload must divide evenly
+        size = next - self.pos
+        if chunk=='TEXS':
+            return size // 29
+        if chunk=='BRUS':
+            n_texs = struct.unpack_from('<i', self.view, self.pos)[0]
+            if not 0 <= n_texs <= limits['textures']:
+                raise B3DError('bad texture count', chunk, self.pos-8, n_texs=n_texs)
+            return (size - 4) // (29 + 4*n_texs)
+        if chunk=='VRTS':
+            flags, tcs, tcss = struct.unpack_from('<3i', self.view, self.pos)
+            if not (0 <= tcs <= limits['textures'] and 0 <= tcss <= 4):
+                raise B3DError('bad texture coordinate sets', chunk, self.pos-8, tcs=tcs, tcss=tcss)
+            stride = 12 + (12 if flags & 1 else 0) + (16 if flags & 2 else 0) + 4*tcs*tcss
+            header = 12
+        elif chunk=='TRIS':
+            stride, header = 12, 4
+        elif chunk=='BONE':
+            stride, header = 8, 0
+        elif chunk=='KEYS':
+            flags = struct.unpack_from('<i', self.view, self.pos)[0]
+            stride = 4 + sum(4*n for bit, name, n in KEYS_FIELDS if flags & bit)
+            header = 4
+        else:
+            return 0
+        if (size - header) % stride:
+            raise B3DError('partial element', chunk, self.pos-8, size=size, stride=stride)
+        return (size - header) // stride
+
+    def wanted(self, chunk):
+        if self.include is not None and chunk not in self.include:
+            return False
+        return chunk not in self.exclude
+
+    def parse_chunk(self, chunk, next):
+        if chunk=='BB3D':
+            self.cb_data(chunk, {'version': self.i(1)[0]})
+
+        elif chunk=='ANIM':
+            flags, frames = self.i(2)
+            fps = self.f(1)[0]
+            self.cb_data(chunk, {'flags':flags, 'frames':frames, 'fps':fps})
+
+        elif chunk=='TEXS':
+            data = []
+            while self.pos<next:
                 name = self.gets()
-                p = self.f(3)
-                s = self.f(3)
-                r = self.f(4)
-                self.cb_data(chunk, {'name':name, 'position':p, 'rotation':r, 'scale':s})
-                continue
+                flags, blend = self.i(2)
+                pos = self.f(2)
+                scale = self.f(2)
+                rot = self.f(1)[0]
+                data.append(dotdict({'name':name,'flags':flags,'blend':blend,'position':pos,'scale':scale,'rotation':rot}))
+            self.cb_data(chunk,{'textures':data})
 
-            elif chunk=='BONE':
+        elif chunk=='BRUS':
+            n_texs = self.i(1)[0]
+            data = []
+            while self.pos<next:
+                name = self.gets()
+                rgba = self.f(4)
+                shine = self.f(1)[0]
+                blend, fx = self.i(2)
+                tids = self.i(n_texs)
+                data.append(dotdict({'name':name, 'rgba':rgba,'shine':shine, 'blend':blend,'fx':fx,'tids':tids}))
+            self.cb_data(chunk, {'materials':data})
+
+        elif chunk=='NODE':
+            name = self.gets()
+            p = self.f(3)
+            s = self.f(3)
+            r = self.f(4)
+            self.cb_data(chunk, {'name':name, 'position':p, 'rotation':r, 'scale':s})
+
+        elif chunk=='BONE':
+            if self.use_arrays:
+                bones = self.array(BONE_DTYPE, next)
+            else:
                 bones = []
-                while self.fp.tell()<next:
+                while self.pos<next:
                     vertex_id = self.i(1)[0]
                     weight = self.f(1)[0]
                     bones.append((vertex_id, weight))
-                self.cb_data(chunk,{'bones': bones})
+            self.cb_data(chunk,{'bones': bones})
 
-            elif chunk=='MESH':
-                self.cb_data(chunk, {'brush_id': self.i(1)[0]})
-                #self.cb_next()
-                #stack.append(next)
-                continue
+        elif chunk=='MESH':
+            self.cb_data(chunk, {'brush_id': self.i(1)[0]})
 
-            elif chunk=='VRTS':
-                flags, tcs, tcss = self.i(3)
+        elif chunk=='VRTS':
+            flags, tcs, tcss = self.i(3)
+            if self.use_arrays:
+                self.cb_data(chunk, self.vrts_arrays(flags, tcs, tcss, next))
+            else:
                 v,n,c,u = [],[],[],[]
-                while self.fp.tell()<next:
+                while self.pos<next:
                     v.append(self.f(3))
                     if flags & 1: n.append(self.f(3))
                     if flags & 2: c.append(self.f(4))
                     if tcs*tcss: u.append(self.f(tcs*tcss))
-                self.cb_data(chunk, {'vertices':v, 'normals':n, 'rgba':c, 'uvs':u})
+                self.cb_data(chunk, {'vertices':v, 'normals':n, 'rgba':c, 'uvs':u,
+                    'tex_coord_sets':tcs, 'tex_coord_set_size':tcss})
 
-            elif chunk=='TRIS':
-                brush_id = self.i(1)[0]
+        elif chunk=='TRIS':
+            brush_id = self.i(1)[0]
+            if self.use_arrays:
+                faces = self.array(TRIS_DTYPE, next)
+            else:
                 faces = []
-                while self.fp.tell()<next:
+                while self.pos<next:
                     vertex_id = self.i(3)
                     faces.append(vertex_id)
-                self.cb_data(chunk, {'brush_id':brush_id, 'indices':faces})
+            self.cb_data(chunk, {'brush_id':brush_id, 'indices':faces})
 
-            elif chunk=='KEYS':
-                flags = self.i(1)[0]
+        elif chunk=='KEYS':
+            flags = self.i(1)[0]
+            if self.use_arrays:
+                keys = self.keys_arrays(flags, next)
+            else:
                 keys = []
-                while self.fp.tell()<next:
+                while self.pos<next:
                     key = dotdict({'frame':self.i(1)[0]})
                     if flags & 1: key['position'] = self.f(3)
                     if flags & 2: key['scale'] = self.f(3)
                     if flags & 4: key['rotation'] = self.f(4)
                     keys.append(key)
-                self.cb_data(chunk, keys)
-
-            self.fp.seek(next)
-
-        return self.cb_result()
+            self.cb_data(chunk, keys)
 
 
 class B3DDebugParser(B3DParser):
-    def __init__(self):
-        B3DParser.__init__(self)
+    def __init__(self, **kwargs):
+        B3DParser.__init__(self, **kwargs)
         self.level = 0
 
     def cb_next(self):
@@ -155,15 +562,165 @@ class dotdict(dict):
     __setattr__ = dict.__setitem__
 
 
+def concat_keys(a, b):
+    # join columnar KEYS, channels missing on either side are NaN-filled
+    if a is None:
+        return b
+    keys = dotdict()
+    for name in ['frames', 'flags']:
+        keys[name] = np.concatenate((a[name], b[name]))
+    for bit, name, n in KEYS_FIELDS:
+        if name in a or name in b:
+            keys[name] = np.concatenate([x[name] if name in x else
+                np.full((len(x.frames), n), np.nan, np.float32) for x in (a, b)])
+    return keys
+
+
+class LazyChunks:
+    # placeholder for node fields whose chunks are decoded on first access
+    def __init__(self, owner, node, tag):
+        self.owner = owner
+        self.node = node
+        self.tag = tag
+        self.entries = []
+        self.size = 0
+
+    def add(self, entry):
+        self.entries.append(entry)
+        self.size += entry.size
+        for name in LAZY_FIELDS[self.tag]:
+            dict.__setitem__(self.node, name, self)
+
+    def load(self):
+        if self.owner.reader is None:
+            raise ValueError('lazy tree was closed, %s is not loaded' % self.tag)
+        for name in LAZY_FIELDS[self.tag]:
+            dict.pop(self.node, name)
+        for entry in self.entries:
+            self.owner.add(self.node, self.tag, self.owner.reader.read(entry))
+        self.owner.touch(self)
+
+    def unload(self):
+        for name in LAZY_FIELDS[self.tag]:
+            dict.__setitem__(self.node, name, self)
+
+
+class LazyNode(dotdict):
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if isinstance(value, LazyChunks):
+            value.load()
+            value = dict.__getitem__(self, key)
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    __getattr__ = get
+
+
 class B3DList(B3DParser):
-    def __init__(self):
-        B3DParser.__init__(self)
+    def __init__(self, lazy=False, cache_size=None, threads=None, **kwargs):
+        B3DParser.__init__(self, **kwargs)
+        if threads and not self.use_arrays:
+            raise ValueError('threads requires use_arrays')
         self.index = -1
         self.data = dotdict()
         self.data.nodes = []
+        self.lazy = lazy
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cached = 0
+        self.reader = None
+        self.threads = threads
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # a lazy tree reads from the source until closed, fields not loaded by then stay unavailable
+        B3DParser.close(self)
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def parse(self, source):
+        if not self.lazy:
+            return B3DParser.parse(self, source)
+        # the reader keeps the source open until close(), parse its view to read it only once
+        self.reader = B3DIndex(use_mmap=self.use_mmap, use_arrays=self.use_arrays)
+        try:
+            self.reader.open(source)
+            filesize = self.open(self.reader.view)
+            self.parse_chunks(filesize)
+        except BaseException:
+            self.close()
+            raise
+        finally:
+            B3DParser.close(self)
+        return self.cb_result()
+
+    def parse_chunks(self, filesize):
+        if not self.threads:
+            return B3DParser.parse_chunks(self, filesize)
+        # walk the structure here, large payloads are decoded by the pool
+        self.readers = []
+        self.local = threading.local()
+        try:
+            with ThreadPoolExecutor(self.threads) as self.pool:
+                B3DParser.parse_chunks(self, filesize)
+                for node, chunk, data in self.pending:
+                    if isinstance(data, Future):
+                        data = data.result()
+                    self.add(node, chunk, data)
+        finally:
+            for reader in self.readers:
+                reader.close()
+            self.pending = []
+
+    def decode_chunk(self, entry):
+        # each worker reads through its own cursor over the shared view
+        reader = getattr(self.local, 'reader', None)
+        if reader is None:
+            reader = self.local.reader = B3DIndex(use_arrays=True)
+            reader.open(self.view)
+            self.readers.append(reader)
+        return reader.read(entry)
+
+    def parse_chunk(self, chunk, next):
+        if self.index == -1:
+            # payload outside any NODE, cb_data drops it like the eager path does
+            B3DParser.parse_chunk(self, chunk, next)
+        elif self.threads and chunk in LAZY_FIELDS and not self.lazy and next-self.pos >= THREADED_CHUNK_SIZE:
+            # smaller chunks are decoded in place, cb_data queues them behind pending tasks
+            entry = dotdict({'tag':chunk, 'offset':self.pos-8, 'size':next-self.pos})
+            self.pending.append((self.data.nodes[self.index], chunk, self.pool.submit(self.decode_chunk, entry)))
+        elif self.lazy and chunk in LAZY_FIELDS:
+            node = self.data.nodes[self.index]
+            ref = dict.get(node, LAZY_FIELDS[chunk][0])
+            if not isinstance(ref, LazyChunks):
+                ref = LazyChunks(self, node, chunk)
+            ref.add(dotdict({'tag':chunk, 'offset':self.pos-8, 'size':next-self.pos}))
+        else:
+            B3DParser.parse_chunk(self, chunk, next)
+
+    def touch(self, ref):
+        # keep decoded payloads under cache_size bytes (measured on disk)
+        if self.cache_size is None:
+            return
+        self.cache[id(ref)] = ref
+        self.cached += ref.size
+        while self.cached > self.cache_size and len(self.cache) > 1:
+            _, old = self.cache.popitem(last=False)
+            self.cached -= old.size
+            old.unload()
 
     def cb_next(self):
-        self.data.nodes.append(dotdict())
+        self.data.nodes.append(LazyNode() if self.lazy else dotdict())
         parent = self.index
         self.index = len(self.data.nodes)-1
         self.data.nodes[self.index].parent = parent
@@ -172,29 +729,37 @@ class B3DList(B3DParser):
         self.index = self.data.nodes[self.index].parent
 
     def cb_data(self, chunk, data):
-        if self.index != -1:
-            node = self.data.nodes[self.index]
+        if chunk in ['ANIM', 'TEXS', 'BRUS']:
+            self.data.update(data)
+        elif self.index != -1:
+            if self.pending:
+                # keep the file order of chunks still decoding in the pool
+                self.pending.append((self.data.nodes[self.index], chunk, data))
+            else:
+                self.add(self.data.nodes[self.index], chunk, data)
 
+    def add(self, node, chunk, data):
         if chunk in ['NODE','MESH','VRTS','BONE']:
             node.update(data)
         elif chunk=='TRIS':
             if 'faces' not in node:
-                node.faces = []
-            node.faces.append(dotdict(data))
+                node['faces'] = []
+            node['faces'].append(dotdict(data))
         elif chunk=='KEYS':
-            if 'keys' not in node:
-                node['keys'] = []
-            node['keys'].extend(data)
-        elif chunk in ['ANIM', 'TEXS', 'BRUS']:
-            self.data.update(data)
+            if isinstance(data, dict):
+                node['keys'] = concat_keys(node.get('keys'), data)
+            else:
+                if 'keys' not in node:
+                    node['keys'] = []
+                node['keys'].extend(data)
 
     def cb_result(self):
         return self.data
 
 
 class B3DTree(B3DList):
-    def __init__(self):
-        B3DList.__init__(self)
+    def __init__(self, **kwargs):
+        B3DList.__init__(self, **kwargs)
 
     def cb_result(self):
         tree = []
@@ -213,21 +778,410 @@ class B3DTree(B3DList):
         self.data.update({'nodes':tree})
         return self.data
 
+class Record(Mapping):
+    # __slots__ records with a read-only dict view over the fields that are set
+    __slots__ = ()
+    fields = ()
+    # fields kept under another attribute name, so they don't hide Mapping methods
+    aliases = {}
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+    def __getitem__(self, key):
+        value = getattr(self, self.aliases.get(key, key)) if key in self.fields else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        return (k for k in self.fields if getattr(self, self.aliases.get(k, k)) is not None)
+
+    def __len__(self):
+        return sum(1 for k in self)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % (k, self[k]) for k in self))
+
+
+class Texture(Record):
+    __slots__ = fields = ('name', 'flags', 'blend', 'position', 'scale', 'rotation')
+
+
+class Brush(Record):
+    __slots__ = fields = ('name', 'rgba', 'shine', 'blend', 'fx', 'tids')
+
+
+class Surface(Record):
+    __slots__ = fields = ('brush_id', 'indices')
+
+
+class Mesh(Record):
+    __slots__ = fields = ('brush_id', 'vertices', 'normals', 'rgba', 'uvs',
+        'tex_coord_sets', 'tex_coord_set_size', 'surfaces')
+
+
+class Bone(Record):
+    __slots__ = fields = ('vertex_ids', 'weights')
+
+
+class KeyTrack(Record):
+    __slots__ = fields = ('frames', 'flags', 'position', 'scale', 'rotation')
+
+
+def mesh_property(name):
+    return property(lambda self: getattr(self.mesh, name) if self.mesh else None)
+
+
+class Node(Record):
+    __slots__ = ('name', 'position', 'rotation', 'scale', 'mesh', 'bone', 'key_track', 'nodes')
+    # B3DTree-compatible keys, mesh and bone data is flattened into the node
+    fields = ('name', 'position', 'rotation', 'scale', 'brush_id', 'vertices',
+        'normals', 'rgba', 'uvs', 'tex_coord_sets', 'tex_coord_set_size', 'faces', 'bones', 'keys', 'nodes')
+    aliases = {'keys': 'key_track'}
+
+    brush_id = mesh_property('brush_id')
+    vertices = mesh_property('vertices')
+    normals = mesh_property('normals')
+    rgba = mesh_property('rgba')
+    uvs = mesh_property('uvs')
+    tex_coord_sets = mesh_property('tex_coord_sets')
+    tex_coord_set_size = mesh_property('tex_coord_set_size')
+    faces = mesh_property('surfaces')
+
+    @property
+    def bones(self):
+        if self.bone:
+            return list(zip(self.bone.vertex_ids.tolist(), self.bone.weights.tolist()))
+
+
+class B3DModel(B3DParser):
+    """Builds a tree of Node records with array-backed fields (needs numpy)."""
+
+    def __init__(self, **kwargs):
+        kwargs['use_arrays'] = True
+        B3DParser.__init__(self, **kwargs)
+        self.data = dotdict({'nodes': [], 'textures': [], 'materials': []})
+        self.stack = []
+
+    def cb_next(self):
+        node = Node(nodes=[])
+        (self.stack[-1].nodes if self.stack else self.data.nodes).append(node)
+        self.stack.append(node)
+
+    def cb_prev(self):
+        del self.stack[-1]
+
+    def cb_data(self, chunk, data):
+        node = self.stack[-1] if self.stack else None
+
+        if chunk=='NODE':
+            node.name = data['name']
+            node.position = data['position']
+            node.rotation = data['rotation']
+            node.scale = data['scale']
+        elif chunk=='MESH':
+            node.mesh = Mesh(brush_id=data['brush_id'], surfaces=[])
+        elif chunk=='VRTS':
+            for name in ['vertices', 'normals', 'rgba', 'uvs', 'tex_coord_sets', 'tex_coord_set_size']:
+                setattr(node.mesh, name, data[name])
+        elif chunk=='TRIS':
+            node.mesh.surfaces.append(Surface(**data))
+        elif chunk=='BONE':
+            bones = data['bones']
+            node.bone = Bone(vertex_ids=np.ascontiguousarray(bones['vertex_id']),
+                weights=np.ascontiguousarray(bones['weight']))
+        elif chunk=='KEYS':
+            keys = dict(node.key_track) if node.key_track else None
+            node.key_track = KeyTrack(**concat_keys(keys, data))
+        elif chunk=='TEXS':
+            self.data.textures = [Texture(**t) for t in data['textures']]
+        elif chunk=='BRUS':
+            self.data.materials = [Brush(**m) for m in data['materials']]
+        elif chunk in ['BB3D', 'ANIM']:
+            self.data.update(data)
+
+    def cb_result(self):
+        return self.data
+
+
+class B3DIndex(B3DParser):
+    """Table of contents built from chunk headers, decodes chunks on demand."""
+
+    def __init__(self, source=None, **kwargs):
+        B3DParser.__init__(self, **kwargs)
+        self.chunks = []
+        self.result = None
+        if source is not None:
+            self.scan(source)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def scan(self, source):
+        filesize = self.open(source)
+        self.chunks = []
+        stack = []
+        while self.pos <= filesize-8:
+            while stack and self.pos >= stack[-1][0]:
+                del stack[-1]
+
+            chunk, pos, size, next = self.next_chunk()
+            parent = stack[-1][1] if stack else -1
+            node = self.chunks[parent].node if stack else None
+            entry = dotdict({'tag':chunk, 'offset':pos, 'size':size,
+                'depth':len(stack), 'parent':parent, 'node':node})
+            self.chunks.append(entry)
+
+            if chunk=='NODE':
+                entry.node = self.gets()
+                self.pos += 40
+            elif chunk in CONTAINERS:
+                self.pos += 4
+            else:
+                self.pos = next
+                continue
+            stack.append((next, len(self.chunks)-1))
+        return self.chunks
+
+    def find(self, tag=None, node=None):
+        return [c for c in self.chunks if (tag is None or c.tag==tag)
+            and (node is None or c.node==node)]
+
+    def read(self, entry):
+        if isinstance(entry, str):
+            entry = self.find(entry)[0]
+        self.pos = entry.offset + 8
+        self.parse_chunk(entry.tag, entry.offset + entry.size + 8)
+        return self.result
+
+    def cb_data(self, chunk, data):
+        self.result = data
+
+
+class B3DScanner(B3DParser):
+    """Counts what a file holds from chunk headers, payloads are never decoded."""
+
+    def scan(self, source):
+        filesize = self.open(source)
+        try:
+            return self.scan_chunks(filesize)
+        finally:
+            self.close()
+
+    def scan_chunks(self, filesize):
+        s = dotdict({'version':0, 'nodes':0, 'depth':0, 'meshes':0, 'vertices':0,
+            'max_vertices':0, 'triangles':0, 'bones':0, 'weights':0, 'keys':0,
+            'frames':0, 'fps':0.0, 'textures':[], 'materials':[]})
+        stack = []
+        while self.pos <= filesize-8:
+            while stack and self.pos >= stack[-1][0]:
+                del stack[-1]
+
+            chunk, pos, size, next = self.next_chunk()
+
+            if chunk=='BB3D':
+                s.version = self.i(1)[0]
+            elif chunk=='NODE':
+                s.nodes += 1
+                s.depth = max(s.depth, 1 + sum(1 for _, tag in stack if tag=='NODE'))
+                self.gets()
+                self.pos += 40
+            elif chunk=='MESH':
+                s.meshes += 1
+                self.pos += 4
+            elif chunk=='VRTS':
+                flags, tcs, tcss = self.i(3)
+                stride = 12 + (12 if flags & 1 else 0) + (16 if flags & 2 else 0) + 4*tcs*tcss
+                count = (size - 12) // stride
+                s.vertices += count
+                s.max_vertices = max(s.max_vertices, count)
+            elif chunk=='TRIS':
+                s.triangles += (size - 4) // 12
+            elif chunk=='BONE':
+                s.bones += 1
+                s.weights += size // 8
+            elif chunk=='KEYS':
+                flags = self.i(1)[0]
+                stride = 4 + sum(4*n for bit, name, n in KEYS_FIELDS if flags & bit)
+                s['keys'] += (size - 4) // stride
+            elif chunk=='ANIM':
+                s.frames = max(s.frames, self.i(2)[1])
+                s.fps = self.f(1)[0]
+            elif chunk=='TEXS':
+                while self.pos<next:
+                    s.textures.append(self.gets())
+                    self.pos += 28
+            elif chunk=='BRUS':
+                n_texs = self.i(1)[0]
+                while self.pos<next:
+                    s.materials.append(self.gets())
+                    self.pos += 28 + 4*n_texs
+
+            if chunk in CONTAINERS:
+                stack.append((next, chunk))
+            else:
+                self.pos = next
+        return s
+
+
+class B3DEvents(B3DParser):
+    def __init__(self, **kwargs):
+        B3DParser.__init__(self, **kwargs)
+        self.events = []
+
+    def cb_next(self):
+        self.events.append(('start', 'NODE', None))
+
+    def cb_prev(self):
+        self.events.append(('end', 'NODE', None))
+
+    def cb_data(self, chunk, data):
+        self.events.append(('data', chunk, data))
+
+
+def iterparse(source, **kwargs):
+    """Yield (event, chunk, data) tuples while reading, without building a tree.
+
+    NODE chunks produce 'start' and 'end' events around their contents,
+    every decoded chunk produces a 'data' event.
+    """
+    parser = B3DEvents(**kwargs)
+    filesize = parser.open(source)
+    try:
+        for _ in parser.iter_chunks(filesize):
+            events, parser.events = parser.events, []
+            yield from events
+        yield from parser.events
+    finally:
+        parser.close()
+
+
 def dump(node, level=0):
     for node in node.nodes:
         print(node.name)
         dump(node, level+1)
 
+def file_stats(filepath, strict=False, scan_only=False):
+    if scan_only:
+        # chunk headers only, payloads are neither decoded nor checked
+        s = B3DScanner(strict=strict).scan(filepath)
+        stats = {k: s[k] for k in ['nodes', 'meshes', 'vertices', 'triangles', 'bones', 'weights', 'keys']}
+        stats['textures'] = len(s.textures)
+        stats['materials'] = len(s.materials)
+        return stats
+    stats = dict.fromkeys(['nodes', 'meshes', 'vertices', 'triangles', 'bones',
+        'weights', 'keys', 'textures', 'materials'], 0)
+    for event, chunk, data in iterparse(filepath, use_arrays=np is not None, strict=strict):
+        if event=='start':
+            stats['nodes'] += 1
+        elif chunk=='MESH':
+            stats['meshes'] += 1
+        elif chunk=='VRTS':
+            stats['vertices'] += len(data['vertices'])
+        elif chunk=='TRIS':
+            stats['triangles'] += len(data['indices'])
+        elif chunk=='BONE':
+            stats['bones'] += 1
+            stats['weights'] += len(data['bones'])
+        elif chunk=='KEYS':
+            stats['keys'] += len(data['frames'] if isinstance(data, dict) else data)
+        elif chunk=='TEXS':
+            stats['textures'] += len(data['textures'])
+        elif chunk=='BRUS':
+            stats['materials'] += len(data['materials'])
+    return stats
+
+def batch_worker(args):
+    filepath, with_json, strict, scan_only = args
+    record = {'path': filepath, 'size': 0}
+    start = time.perf_counter()
+    try:
+        record['size'] = os.path.getsize(filepath)
+        record['stats'] = file_stats(filepath, strict, scan_only)
+        if with_json:
+            record['data'] = B3DTree(strict=strict).parse(filepath)
+    except Exception as e:
+        record['error'] = '%s: %s' % (type(e).__name__, e)
+        if isinstance(e, B3DError):
+            record['error_info'] = e.as_dict()
+    record['time'] = time.perf_counter() - start
+    return record
+
+def find_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith('.b3d'):
+                        yield os.path.join(root, name)
+        elif glob.has_magic(path):
+            yield from sorted(glob.glob(path, recursive=True))
+        else:
+            yield path
+
+def batch(paths, workers=None, with_json=False, out=sys.stdout, strict=False, scan_only=False):
+    import json
+    from concurrent.futures import ProcessPoolExecutor
+
+    files = list(find_files(paths))
+    jobs = [(f, with_json, strict, scan_only) for f in files]
+    start = time.perf_counter()
+    total = errors = 0
+    pool = ProcessPoolExecutor(workers) if workers != 1 else None
+    try:
+        # small files dominate asset libraries, hand them out in batches
+        results = pool.map(batch_worker, jobs, chunksize=8) if pool else map(batch_worker, jobs)
+        for record in results:
+            total += record['size']
+            errors += 'error' in record
+            out.write(json.dumps(record) + '\n')
+            out.flush()
+    finally:
+        if pool:
+            pool.shutdown()
+    elapsed = time.perf_counter() - start
+    summary = {'files': len(files), 'errors': errors, 'bytes': total, 'time': elapsed,
+        'files_per_sec': len(files)/elapsed if elapsed else 0,
+        'mb_per_sec': total/1e6/elapsed if elapsed else 0}
+    print('%(files)d files, %(errors)d errors, %(time).2fs, '
+        '%(files_per_sec).1f files/s, %(mb_per_sec).1f MB/s' % summary, file=sys.stderr)
+    return summary
+
 if __name__ == '__main__':
-    import sys
-    if len(sys.argv)<2:
-        print('Usage: B3DParser.py [filename.b3d]')
+    import argparse
+    parser = argparse.ArgumentParser(description='Dump a .b3d file as a JSON tree, '
+        'or scan many files and print one NDJSON record per file.')
+    parser.add_argument('paths', nargs='+', metavar='path', help='.b3d files, directories or globs')
+    parser.add_argument('--batch', action='store_true', help='batch mode even for a single file')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--json', action='store_true', help='include the parsed tree in batch records')
+    parser.add_argument('--scan-only', action='store_true', help='count from chunk headers in batch mode, '
+        'payloads are not decoded')
+    parser.add_argument('--profile', action='store_true', help='print a per chunk breakdown instead of the tree')
+    parser.add_argument('--strict', action='store_true', help='validate chunk bounds and cap allocations, '
+        'fail on the first problem')
+    args = parser.parse_args()
+
+    filepath = args.paths[0]
+    if args.batch or len(args.paths)>1 or os.path.isdir(filepath) or glob.has_magic(filepath):
+        summary = batch(args.paths, args.workers, args.json, strict=args.strict, scan_only=args.scan_only)
+        sys.exit(1 if summary['errors'] else 0)
+
+    if args.profile:
+        p = B3DTree(profile=True, strict=args.strict)
+        p.parse(filepath)
+        print(p.stats.table())
         sys.exit(0)
-    filepath = sys.argv[1]
+
     #B3DDebugParser().parse(filepath) # text dump
     #data = B3DList().parse(filepath) # json list
-    data = B3DTree().parse(filepath) # json tree
+    data = B3DTree(strict=args.strict).parse(filepath) # json tree
     import json
     print(json.dumps(data, indent=1))
     #dump(data)
-
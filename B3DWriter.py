@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+# Blender-free .b3d writer for io_scene_b3d
+
+import struct
+import argparse
+from itertools import groupby
+from collections.abc import Mapping
+from contextlib import contextmanager
+
+try:
+    from .B3DParser import B3DTree, KEYS_FIELDS, np
+except ImportError:
+    from B3DParser import B3DTree, KEYS_FIELDS, np
+
+#Support Functions
+def write_int(value):
+    return struct.pack("<i",value)
+
+def write_float(value):
+    return struct.pack("<f",value)
+
+def write_float_couple(value1, value2):
+    return struct.pack("<ff", value1, value2)
+
+def write_float_triplet(value1, value2, value3):
+    return struct.pack("<fff", value1, value2, value3)
+
+def write_float_quad(value1, value2, value3, value4):
+    return struct.pack("<ffff", value1, value2, value3, value4)
+
+def write_string(value):
+    binary_format = "<%ds"%(len(value)+1)
+    return struct.pack(binary_format, str.encode(value))
+
+def write_chunk(name,value):
+    dummy = bytearray()
+    return dummy + name + write_int(len(value)) + value
+
+def empty(values):
+    return values is None or len(values) == 0
+
+class B3DWriter:
+    """Streams chunks to a seekable file, sizes are patched in when a chunk ends.
+
+    write() takes B3DTree or B3DModel shaped data, with lists or arrays.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.stack = []
+
+    def begin(self, tag):
+        self.fp.write(tag.encode() + b'\0\0\0\0')
+        self.stack.append(self.fp.tell())
+
+    def end(self):
+        start = self.stack.pop()
+        end = self.fp.tell()
+        self.fp.seek(start - 4)
+        self.fp.write(write_int(end - start))
+        self.fp.seek(end)
+
+    @contextmanager
+    def chunk(self, tag):
+        self.begin(tag)
+        yield self
+        self.end()
+
+    def ints(self, *values):
+        self.fp.write(struct.pack('<%di' % len(values), *values))
+
+    def floats(self, *values):
+        self.fp.write(struct.pack('<%df' % len(values), *values))
+
+    def string(self, value):
+        self.fp.write(write_string(value))
+
+    def table(self, columns):
+        # interleaves (values, 'i' or 'f', width) columns row by row
+        count = len(columns[0][0])
+        if not count:
+            return
+        if np is not None:
+            dtype = np.dtype([('f%d' % k, '<%s4' % c, (n,)) for k, (_, c, n) in enumerate(columns)])
+            a = np.empty(count, dtype)
+            for k, (values, c, n) in enumerate(columns):
+                a['f%d' % k] = np.asarray(values).reshape(count, n)
+            self.fp.write(a.tobytes())
+            return
+        row = struct.Struct('<' + ''.join('%d%s' % (n, c) for _, c, n in columns))
+        out = []
+        for values in zip(*[v for v, _, _ in columns]):
+            args = []
+            for v in values:
+                if isinstance(v, (tuple, list)):
+                    args.extend(v)
+                else:
+                    args.append(v)
+            out.append(row.pack(*args))
+        self.fp.write(b''.join(out))
+
+    def write(self, data):
+        with self.chunk('BB3D'):
+            self.ints(data.get('version') or 1)
+            if not empty(data.get('textures')):
+                self.write_texs(data['textures'])
+            if not empty(data.get('materials')):
+                self.write_brus(data['materials'])
+            for i, node in enumerate(data.get('nodes') or []):
+                # the parsers keep a single ANIM per file, it goes back on the root
+                self.write_node(node, data if i == 0 and 'frames' in data else None)
+
+    def write_texs(self, textures):
+        with self.chunk('TEXS'):
+            for t in textures:
+                self.string(t['name'])
+                self.ints(t.get('flags', 1), t.get('blend', 2))
+                self.floats(*t['position'], *t['scale'], t['rotation'])
+
+    def write_brus(self, materials):
+        n_texs = max(len(m['tids']) for m in materials)
+        with self.chunk('BRUS'):
+            self.ints(n_texs)
+            for m in materials:
+                self.string(m['name'])
+                self.floats(*m['rgba'], m['shine'])
+                self.ints(m['blend'], m['fx'])
+                tids = list(m['tids'])
+                self.ints(*(tids + [-1] * (n_texs - len(tids))))
+
+    def write_node(self, node, anim=None):
+        with self.chunk('NODE'):
+            self.string(node.get('name') or '')
+            self.floats(*node['position'], *node['scale'], *node['rotation'])
+            bone = getattr(node, 'bone', None)
+            if 'brush_id' in node:
+                self.write_mesh(node)
+            elif bone:
+                self.write_bone(bone.vertex_ids, bone.weights)
+            elif node.get('bones') is not None:
+                bones = node['bones']
+                if np is not None and isinstance(bones, np.ndarray):
+                    self.write_bone(bones['vertex_id'], bones['weight'])
+                else:
+                    self.write_bone([b[0] for b in bones], [b[1] for b in bones])
+            if not empty(node.get('keys')):
+                self.write_keys(node['keys'])
+            if anim:
+                with self.chunk('ANIM'):
+                    self.ints(anim.get('flags') or 0, anim['frames'])
+                    self.floats(anim.get('fps') or 60.0)
+            for child in node.get('nodes') or []:
+                self.write_node(child)
+
+    def write_mesh(self, node):
+        with self.chunk('MESH'):
+            self.ints(node['brush_id'])
+            if node.get('vertices') is not None:
+                self.write_vrts(node['vertices'], node.get('normals'), node.get('rgba'), node.get('uvs'),
+                    node.get('tex_coord_sets'), node.get('tex_coord_set_size'))
+            for face in node.get('faces') or []:
+                with self.chunk('TRIS'):
+                    self.ints(face['brush_id'])
+                    self.table([(face['indices'], 'i', 3)])
+
+    def write_vrts(self, vertices, normals, rgba, uvs, tcs=None, tcss=None):
+        flags = (0 if empty(normals) else 1) | (0 if empty(rgba) else 2)
+        width = 0 if empty(uvs) else len(uvs[0])
+        if tcs is None or tcss is None:
+            # hand built data without a layout, assume U/V sets when the width divides
+            tcs, tcss = (width // 2, 2) if width % 2 == 0 else (1, width)
+        columns = [(vertices, 'f', 3)]
+        if flags & 1: columns.append((normals, 'f', 3))
+        if flags & 2: columns.append((rgba, 'f', 4))
+        if width: columns.append((uvs, 'f', width))
+        with self.chunk('VRTS'):
+            self.ints(flags, tcs, tcss)
+            self.table(columns)
+
+    def write_bone(self, vertex_ids, weights):
+        with self.chunk('BONE'):
+            self.table([(vertex_ids, 'i', 1), (weights, 'f', 1)])
+
+    def write_keys(self, keys):
+        if isinstance(keys, Mapping):
+            # columnar keys, one chunk per run of keys with the same channels
+            frames, flags = keys['frames'], keys['flags']
+            bounds = [0] + (np.flatnonzero(np.diff(flags)) + 1).tolist() + [len(frames)]
+            for start, end in zip(bounds, bounds[1:]):
+                flag = int(flags[start])
+                columns = [(frames[start:end], 'i', 1)]
+                columns += [(keys[name][start:end], 'f', n) for bit, name, n in KEYS_FIELDS if flag & bit]
+                with self.chunk('KEYS'):
+                    self.ints(flag)
+                    self.table(columns)
+            return
+        channels = lambda key: sum(bit for bit, name, n in KEYS_FIELDS if name in key)
+        for flag, run in groupby(keys, channels):
+            run = list(run)
+            columns = [([key['frame'] for key in run], 'i', 1)]
+            columns += [([key[name] for key in run], 'f', n) for bit, name, n in KEYS_FIELDS if flag & bit]
+            with self.chunk('KEYS'):
+                self.ints(flag)
+                self.table(columns)
+
+def save(data, filepath):
+    with open(filepath, 'wb') as fp:
+        B3DWriter(fp).write(data)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parse a .b3d file and write it back out.')
+    parser.add_argument('source', help='.b3d file to read')
+    parser.add_argument('dest', help='.b3d file to write')
+    args = parser.parse_args()
+    save(B3DTree(use_arrays=np is not None).parse(args.source), args.dest)
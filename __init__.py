@@ -81,6 +81,12 @@ class ImportB3D(bpy.types.Operator, ImportHelper):
                         "importing incorrectly",
             default=True,
             )
+    use_cache: BoolProperty(
+            name="Cache Parsed Files",
+            description="Keep parsed files in a disk cache so re-importing "
+                        "an unchanged file skips parsing (requires NumPy)",
+            default=False,
+            )
 
     def execute(self, context):
         from . import import_b3d
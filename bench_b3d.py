@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+# Parser benchmarks on synthetic .b3d files, runs without Blender
+
+import os
+import sys
+import json
+import time
+import struct
+import tempfile
+import argparse
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from B3DParser import *
+
+SCENARIOS = {
+    'mesh': dict(vertices=200000, flags=1, uv_sets=1, triangles=200000),
+    'colors': dict(vertices=200000, flags=3, uv_sets=2, triangles=200000),
+    'skinned': dict(vertices=50000, flags=1, uv_sets=1, triangles=50000,
+        bones=64, weights=4, keyframes=1000, depth=8),
+    'deep': dict(vertices=1000, triangles=1000, bones=2000, weights=1,
+        keyframes=50, depth=200),
+}
+
+def chunk(tag, body):
+    return tag + struct.pack('<i', len(body)) + body
+
+def floats(values):
+    a = array('f', values)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a.tobytes()
+
+def ints(values):
+    a = array('i', values)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a.tobytes()
+
+def node(name, body, position=(0,0,0)):
+    return chunk(b'NODE', name.encode() + b'\0' + floats(position) +
+        floats((1,1,1)) + floats((1,0,0,0)) + body)
+
+def synth_b3d(vertices=1000, flags=1, uv_sets=1, uv_size=2, triangles=1000,
+        bones=0, weights=1, keyframes=0, depth=1):
+    """Build a .b3d file in memory.
+
+    flags uses the VRTS bits (1 normals, 2 colors). Bones are laid out
+    as chains of up to depth nodes below the mesh node, each one with
+    an equal share of the vertices*weights skin weights and keyframes
+    position/scale/rotation keys.
+    """
+    stride = 3 + (3 if flags & 1 else 0) + (4 if flags & 2 else 0) + uv_sets*uv_size
+    vrts = ints((flags, uv_sets, uv_size)) + floats(
+        ((i*7 + j) % 101) / 101.0 for i in range(vertices) for j in range(stride))
+    tris = ints([0]) + ints((i+j) % vertices for i in range(triangles) for j in range(3))
+    mesh = chunk(b'MESH', ints([0]) + chunk(b'VRTS', vrts) + chunk(b'TRIS', tris))
+
+    per_bone = vertices * weights // bones if bones else 0
+    keys = chunk(b'KEYS', ints([7]) + b''.join(ints([f]) +
+        floats((f, 0, 0, 1, 1, 1, 1, 0, 0, 0)) for f in range(keyframes))) if keyframes else b''
+
+    def bone(i):
+        start = i * per_bone
+        skin = b''.join(ints([(start + k) % vertices]) + floats([0.5]) for k in range(per_bone))
+        return chunk(b'BONE', skin) + keys
+
+    chains = []
+    for first in range(0, bones, max(depth, 1)):
+        body = b''
+        for i in reversed(range(first, min(first + depth, bones))):
+            body = node('bone%d' % i, bone(i) + body, (0, 1, 0))
+        chains.append(body)
+
+    texs = chunk(b'TEXS', b'skin.png\0' + ints((1, 2)) + floats((0, 0, 1, 1, 0)))
+    brus = chunk(b'BRUS', ints([1]) + b'skin\0' + floats((1, 1, 1, 1, 0)) + ints((1, 0, 0)))
+    anim = chunk(b'ANIM', ints((0, keyframes)) + floats([30])) if keyframes else b''
+    root = node('root', anim + mesh + b''.join(chains))
+    return chunk(b'BB3D', ints([1]) + texs + brus + root)
+
+def consume(iterable):
+    for _ in iterable:
+        pass
+
+def index_query(path):
+    # table of contents plus the by-node lookup, which must still work once open
+    with B3DIndex(path) as index:
+        entry = index.find('VRTS', node='root')[0]
+        assert len(index.read(entry)['vertices']) and index.find('NODE')
+        index.read('TRIS')
+
+def lazy_parse(path):
+    # the lazy tree keeps the file open until closed
+    with B3DTree(lazy=True) as parser:
+        return parser.parse(path)
+
+def debug_parse(path):
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        B3DDebugParser().parse(path)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+PARSERS = {
+    'debug': debug_parse,
+    'list': lambda path: B3DList().parse(path),
+    'tree': lambda path: B3DTree().parse(path),
+    'tree-arrays': lambda path: B3DTree(use_arrays=True).parse(path),
+    'tree-threads': lambda path: B3DTree(use_arrays=True, threads=os.cpu_count()).parse(path),
+    'model': lambda path: B3DModel().parse(path),
+    'lazy': lazy_parse,
+    'index': index_query,
+    'iterparse': lambda path: consume(iterparse(path, use_arrays=np is not None)),
+}
+
+NEEDS_NUMPY = ['tree-arrays', 'tree-threads', 'model']
+
+OVERRIDES = ['vertices', 'flags', 'uv_sets', 'triangles', 'bones', 'weights', 'keyframes', 'depth']
+
+def peak_rss():
+    if resource is None:
+        return 0.0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (1<<20 if sys.platform == 'darwin' else 1<<10)
+
+def run_case(name, path, repeat):
+    # runs in a fresh process so peak RSS belongs to this parser alone
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        PARSERS[name](path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, peak_rss()
+
+def bench(scenarios, parsers, repeat=3, workdir=None):
+    results = {}
+    if workdir is None:
+        with tempfile.TemporaryDirectory(prefix='b3d_bench_') as workdir:
+            return bench(scenarios, parsers, repeat, workdir)
+    for scenario, params in scenarios.items():
+        path = os.path.join(workdir, scenario + '.b3d')
+        with open(path, 'wb') as fp:
+            fp.write(synth_b3d(**params))
+        size = os.path.getsize(path)
+        for name in parsers:
+            with ProcessPoolExecutor(1) as pool:
+                seconds, rss = pool.submit(run_case, name, path, repeat).result()
+            results['%s/%s' % (scenario, name)] = {
+                'seconds': seconds, 'bytes': size,
+                'mb_per_sec': size / 1e6 / seconds,
+                'vertices_per_sec': params.get('vertices', 0) / seconds,
+                'peak_rss_mb': rss,
+            }
+        os.remove(path)
+    return results
+
+def compare(results, baseline, threshold):
+    failures = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        for metric in ['seconds', 'peak_rss_mb']:
+            if base[metric] and result[metric] > base[metric] * (1 + threshold):
+                failures.append('%s %s: %.3f > %.3f (+%d%%)' % (key, metric, result[metric],
+                    base[metric], (result[metric]/base[metric] - 1) * 100))
+    return failures
+
+def table(results):
+    lines = ['%-24s %10s %10s %14s %10s' % ('case', 'seconds', 'MB/s', 'vertices/s', 'RSS MB')]
+    for key, r in results.items():
+        lines.append('%-24s %10.3f %10.1f %14.0f %10.1f' % (key, r['seconds'],
+            r['mb_per_sec'], r['vertices_per_sec'], r['peak_rss_mb']))
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the B3D parsers on synthetic files.')
+    parser.add_argument('-s', '--scenario', action='append', choices=sorted(SCENARIOS),
+        help='scenario to run (default: all)')
+    parser.add_argument('-p', '--parser', action='append', choices=sorted(PARSERS),
+        help='parser to time (default: all available)')
+    parser.add_argument('-n', '--repeat', type=int, default=3, help='runs per case, the best is kept')
+    for name in OVERRIDES:
+        parser.add_argument('--' + name.replace('_', '-'), type=int, dest=name,
+            help='override %s in every scenario' % name)
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25,
+        help='allowed slowdown or RSS growth over the baseline (default: 0.25)')
+    parser.add_argument('--save', help='write the results as JSON, e.g. to use as a baseline')
+    args = parser.parse_args()
+
+    scenarios = {}
+    for name in args.scenario or sorted(SCENARIOS):
+        params = dict(SCENARIOS[name])
+        params.update({k: getattr(args, k) for k in OVERRIDES if getattr(args, k) is not None})
+        scenarios[name] = params
+    parsers = args.parser or [p for p in PARSERS if np is not None or p not in NEEDS_NUMPY]
+
+    results = bench(scenarios, parsers, args.repeat)
+    print(table(results))
+
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            failures = compare(results, json.load(fp), args.threshold)
+        for failure in failures:
+            print('REGRESSION', failure, file=sys.stderr)
+        sys.exit(1 if failures else 0)
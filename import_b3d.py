@@ -8,22 +8,20 @@ except:
 
 try:
     from .B3DParser import *
+    import numpy as np
     import bpy
     import mathutils
     from bpy_extras.image_utils import load_image
-    from bpy_extras.io_utils import unpack_list, unpack_face_list
-    import bmesh
 except:
     pass
 
 def flip(v):
     return ((v[0],v[2],v[1]) if len(v)<4 else (v[0], v[1],v[3],v[2]))
 
-def flip_all(v):
-    return [y for y in [flip(x) for x in v]]
-
 material_mapping = {}
-weighting = {}
+
+# vertex weights are grouped after rounding to this many decimals
+WEIGHT_DECIMALS = 4
 
 """
 def make_skeleton(node):
@@ -174,120 +172,171 @@ def import_mesh(node, parent):
 
     mesh = bpy.data.meshes.new(node.name)
 
-    # join face arrays
-    faces = []
-    for face in node.faces:
-        faces.extend(face.indices)
+    # swap Y/Z for Blender, which also reverses the winding
+    vertices = np.asarray(node.vertices, np.float32).reshape(-1, 3)[:, [0, 2, 1]]
+    faces = [np.asarray(face.indices, np.int32).reshape(-1, 3) for face in node.faces]
+    faces = np.concatenate(faces)[:, [0, 2, 1]] if faces else np.empty((0, 3), np.int32)
 
     # create mesh from data
-    mesh.from_pydata(flip_all(node.vertices), [], flip_all(faces))
-
-    # assign normals
-    mesh.vertices.foreach_set('normal', unpack_list(node.normals))
+    mesh.vertices.add(len(vertices))
+    mesh.vertices.foreach_set('co', vertices.ravel())
+    mesh.loops.add(faces.size)
+    mesh.loops.foreach_set('vertex_index', faces.ravel())
+    mesh.polygons.add(len(faces))
+    mesh.polygons.foreach_set('loop_start', np.arange(0, faces.size, 3, dtype=np.int32))
+    if bpy.app.version < (4, 0, 0):
+        # derived from loop_start since 4.0
+        mesh.polygons.foreach_set('loop_total', np.full(len(faces), 3, np.int32))
+    mesh.update(calc_edges=True)
+
+    # assign normals (read-only since 4.1)
+    normals = np.asarray(node.normals, np.float32).reshape(-1, 3)
+    if len(normals) == len(vertices) and bpy.app.version < (4, 1, 0):
+        mesh.vertices.foreach_set('normal', normals[:, [0, 2, 1]].ravel())
+
+    # per-vertex data is expanded to loops by fancy indexing
+    loops = np.empty(len(mesh.loops), np.int32)
+    mesh.loops.foreach_get('vertex_index', loops)
+
+    # assign uv coordinates, one layer per texture coordinate set
+    tcs, tcss = node.get('tex_coord_sets') or 0, node.get('tex_coord_set_size') or 0
+    uvs = np.asarray(node.uvs, np.float32)
+    if uvs.shape != (len(vertices), tcs*tcss) or tcss < 2:
+        tcs = 0
+    for i in range(min(tcs, 8)):
+        uv = uvs[loops, i*tcss:i*tcss+2]
+        uv[:, 1] = 1 - uv[:, 1]
+        mesh.uv_layers.new().data.foreach_set('uv', uv.ravel())
+
+    # assign vertex colors
+    rgba = np.asarray(node.rgba, np.float32).reshape(-1, 4)
+    if len(rgba) and len(rgba) == len(vertices):
+        if hasattr(mesh, 'color_attributes'):
+            colors = mesh.color_attributes.new('Col', 'FLOAT_COLOR', 'POINT')
+        else:
+            colors = mesh.vertex_colors.new(name='Col')
+            rgba = rgba[loops]
+        colors.data.foreach_set('color', rgba.ravel())
 
     # create object from mesh
     ob = bpy.data.objects.new(node.name, mesh)
 
-    # assign uv coordinates
-    bpymesh = ob.data
-    uvs = [(0,0) if len(uv)==0 else (uv[0], 1-uv[1]) for uv in node.uvs]
-    uvlist = [i for poly in bpymesh.polygons for vidx in poly.vertices for i in uvs[vidx]]
-    bpymesh.uv_layers.new().data.foreach_set('uv', uvlist)
+    # per-polygon brush ids, surfaces without one use the mesh brush
+    brush_ids = np.repeat([face.brush_id for face in node.faces],
+        [len(face.indices) for face in node.faces]).astype(np.int32)
+    brush_ids[brush_ids == -1] = node.get('brush_id', -1)
 
-    # adding object materials (insert-ordered)
-    for key, value in material_mapping.items():
-        ob.data.materials.append(bpy.data.materials[value])
+    # adding object materials, only the ones this mesh uses (in brush order)
+    used = [i for i in np.unique(brush_ids).tolist() if i in material_mapping]
+    for i in used:
+        ob.data.materials.append(bpy.data.materials[material_mapping[i]])
 
     # assign material_indexes
-    poly = 0
-    for face in node.faces:
-        for _ in face.indices:
-            ob.data.polygons[poly].material_index = face.brush_id
-            poly += 1
+    if used:
+        slots = np.zeros(len(brush_ids), np.int32)
+        known = np.isin(brush_ids, used)
+        slots[known] = np.searchsorted(used, brush_ids[known])
+        ob.data.polygons.foreach_set('material_index', slots)
 
     return ob
 
-def select_recursive(root):
-    for c in root.children:
-        select_recursive(c)
-    root.select_set(state=True)
-
-def make_armature_recursive(root, a, parent_bone):
-    bone = a.data.edit_bones.new(root.name)
-    v = root.matrix_world.to_translation()
-    bone.tail = v
-    # bone.head = (v[0]-0.01,v[1],v[2]) # large handles!
-    bone.parent = parent_bone
-    if bone.parent:
-        bone.head = bone.parent.tail
-    parent_bone = bone
-    for c in root.children:
-        make_armature_recursive(c, a, parent_bone)
+def add_weights(group, bones):
+    # one group.add per distinct (quantized) weight instead of one per vertex
+    bones = np.asarray(bones)
+    if bones.dtype.names:
+        vertex_ids, weights = bones['vertex_id'], bones['weight']
+    else:
+        vertex_ids, weights = bones.reshape(-1, 2).T
+    vertex_ids = vertex_ids.astype(np.int32)
+    weights = np.round(weights, WEIGHT_DECIMALS)
+    order = np.argsort(weights, kind='stable')
+    vertex_ids, weights = vertex_ids[order], weights[order]
+    starts = np.flatnonzero(np.diff(weights, prepend=np.nan))
+    for ids, weight in zip(np.split(vertex_ids, starts[1:]), weights[starts]):
+        group.add(ids.tolist(), float(weight), 'REPLACE')
+
+def node_matrix(node):
+    return (mathutils.Matrix.Translation(flip(node.position)) @
+        mathutils.Quaternion(flip(node.rotation)).to_matrix().to_4x4() @
+        mathutils.Matrix.Diagonal(tuple(flip(node.scale)) + (1,)))
 
 def make_armatures():
     global ctx
-    global imported_armatures, weighting
+    global imported_armatures
 
-    for dummy_root in imported_armatures:
+    rigs = []
+    for rig in imported_armatures:
         objName = 'armature'
         a = bpy.data.objects.new(objName, bpy.data.armatures.new(objName))
         ctx.scene.collection.objects.link(a)
-        for i in bpy.context.selected_objects: i.select_set(state=False)
-        a.select_set(state=True)
         a.show_in_front = True
         a.data.display_type = 'OCTAHEDRAL'
-        bpy.context.view_layer.objects.active = a
+        # armature space is the mesh space the bone matrices are relative to
+        a.parent = rig['mesh']
+        rigs.append((rig, a))
 
-        bpy.ops.object.mode_set(mode='EDIT',toggle=False)
-        make_armature_recursive(dummy_root, a, None)
-        bpy.ops.object.mode_set(mode='OBJECT',toggle=False)
+    if not rigs:
+        return
 
-        # set ob to mesh object
-        ob = dummy_root.parent
-        a.parent = ob
+    # bones can only be added in edit mode, enter it once for all rigs together
+    for i in bpy.context.selected_objects: i.select_set(state=False)
+    for rig, a in rigs: a.select_set(state=True)
+    bpy.context.view_layer.objects.active = rigs[0][1]
 
-        # delete dummy objects hierarchy
-        for i in bpy.context.selected_objects: i.select_set(state=False)
-        select_recursive(dummy_root)
-        bpy.ops.object.delete(use_global=True)
+    bpy.ops.object.mode_set(mode='EDIT',toggle=False)
+    for rig, a in rigs:
+        edit_bones = []
+        for node, parent_index, matrix in rig['bones']:
+            bone = a.data.edit_bones.new(node.name)
+            bone.tail = matrix.to_translation()
+            if parent_index is not None:
+                bone.parent = edit_bones[parent_index]
+                bone.head = bone.parent.tail
+            # zero length bones are dropped when leaving edit mode
+            if (bone.tail - bone.head).length < 1e-5:
+                bone.tail = bone.head + mathutils.Vector((0, 0.01, 0))
+            edit_bones.append(bone)
+        rig['names'] = [bone.name for bone in edit_bones]
+    bpy.ops.object.mode_set(mode='OBJECT',toggle=False)
+
+    for rig, a in rigs:
+        ob = rig['mesh']
 
         # apply armature modifier
         modifier = ob.modifiers.new(type="ARMATURE", name="armature")
         modifier.object = a
 
-        # create vertex groups
-        for bone in a.data.bones.values():
-            group = ob.vertex_groups.new(name=bone.name)
-            if bone.name in weighting.keys():
-                for vertex_id, weight in weighting[bone.name]:
-                    group_indices = [vertex_id]
-                    group.add(group_indices, weight, 'REPLACE')
-        a.parent.data.update()
-
-def import_bone(node, parent=None):
-    global imported_armatures, weighting
-    # add dummy objects to calculate bone positions later
-    ob = bpy.data.objects.new(node.name, None)
-
-    # fill weighting map for later use
-    w = []
-    for vert_id, weight in node['bones']:
-        w.append((vert_id, weight))
-    weighting[node.name] = w
-
-    # check parent, add root armature
-    if parent and parent.type=='MESH':
-        imported_armatures.append(ob)
+        # create vertex groups, weights stay with their node so duplicate names don't collide
+        for name, (node, parent_index, matrix) in zip(rig['names'], rig['bones']):
+            group = ob.vertex_groups.new(name=name)
+            bones = node.get('bones')
+            if bones is not None and len(bones):
+                add_weights(group, bones)
+        ob.data.update()
+
+def import_bone(node, parent, bone):
+    global imported_armatures
+    # bones get no objects, only their matrix relative to the skinned mesh
+    if bone:
+        rig, parent_index, parent_matrix = bone
+    else:
+        rig = {'mesh': parent, 'bones': []}
+        imported_armatures.append(rig)
+        parent_index, parent_matrix = None, mathutils.Matrix.Identity(4)
 
-    return ob
+    matrix = parent_matrix @ node_matrix(node)
+    rig['bones'].append((node, parent_index, matrix))
+    return rig, len(rig['bones'])-1, matrix
 
-def import_node_recursive(node, parent=None):
+def import_node_recursive(node, parent=None, bone=None):
+    # bone is (rig, index, matrix) while walking a skeleton below a mesh
     ob = None
 
     if 'vertices' in node and 'faces' in node:
         ob = import_mesh(node, parent)
-    elif 'bones' in node:
-        ob = import_bone(node, parent)
+    elif bone or 'bones' in node and parent and parent.type=='MESH':
+        # below a bone every other node is a bone too, with or without weights
+        bone = import_bone(node, parent, bone)
     elif node.name:
         ob = bpy.data.objects.new(node.name, None)
 
@@ -298,25 +347,36 @@ def import_node_recursive(node, parent=None):
             ob.parent = parent
 
         ob.rotation_mode='QUATERNION'
-        ob.rotation_quaternion = flip(node.rotation)
-        ob.scale = flip(node.scale)
-        ob.location = flip(node.position)
+        if bone:
+            # a mesh attached to a bone, keep its rest position in the mesh space
+            ob.parent = bone[0]['mesh']
+            ob.matrix_basis = bone[2] @ node_matrix(node)
+        else:
+            ob.rotation_quaternion = flip(node.rotation)
+            ob.scale = flip(node.scale)
+            ob.location = flip(node.position)
+        bone = None
 
     for x in node.nodes:
-        import_node_recursive(x, ob)
+        import_node_recursive(x, parent if bone else ob, bone)
 
 def load_b3d(filepath,
              context,
              IMPORT_CONSTRAIN_BOUNDS=10.0,
              IMAGE_SEARCH=True,
              APPLY_MATRIX=True,
+             USE_CACHE=False,
              global_matrix=None):
 
     global ctx
     global material_mapping
 
     ctx = context
-    data = B3DTree().parse(filepath)
+    if USE_CACHE:
+        from .B3DCache import B3DCache
+        data = B3DCache().parse(filepath)
+    else:
+        data = B3DTree(use_arrays=True).parse(filepath)
 
     # load images
     images = {}
@@ -347,9 +407,8 @@ def load_b3d(filepath,
             texImage.image = image
             material.node_tree.links.new(bsdf.inputs['Base Color'], texImage.outputs['Color'])
 
-    global imported_armatures, weighting
+    global imported_armatures
     imported_armatures = []
-    weighting = {}
 
     import_node_recursive(data)
     make_armatures()
@@ -360,6 +419,7 @@ def load(operator,
          constrain_size=0.0,
          use_image_search=True,
          use_apply_transform=True,
+         use_cache=False,
          global_matrix=None,
          ):
 
@@ -368,6 +428,7 @@ def load(operator,
              IMPORT_CONSTRAIN_BOUNDS=constrain_size,
              IMAGE_SEARCH=use_image_search,
              APPLY_MATRIX=use_apply_transform,
+             USE_CACHE=use_cache,
              global_matrix=global_matrix,
              )
 